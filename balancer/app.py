@@ -30,8 +30,9 @@ from privex.helpers import empty, retry_on_err
 from werkzeug.exceptions import BadRequest
 import logging
 from asyncio import sleep
-from balancer.core import MAX_BATCH, CHUNK_SIZE
-from balancer.node import find_endpoint, Endpoint
+from balancer.core import MAX_BATCH, CHUNK_SIZE, BROADCAST_FANOUT, BROADCAST_TIMEOUT, broadcast_calls, \
+    broadcast_dupe_errors
+from balancer.node import find_endpoint, find_endpoints, Endpoint
 
 log = logging.getLogger(__name__)
 
@@ -137,10 +138,141 @@ async def make_batch_call(method, data):
         )
 
 
-async def make_call(method, params, jid=1):
-    _method = method
+def call_method(method, params) -> str:
+    """
+    Returns the real method being called, i.e. ``call`` with the params ``['condenser_api', 'get_block', [1]]``
+    becomes ``condenser_api.get_block``. Other methods are returned as-is.
+    """
     if method == 'call':
-        _method = '.'.join(list(params[:-1]))
+        return '.'.join(list(params[:-1]))
+    return method
+
+
+def is_broadcast(method, params) -> bool:
+    """Returns True if the method/params are a transaction broadcast, which should be sent via broadcast_call"""
+    try:
+        return call_method(method, params).split('.')[-1] in broadcast_calls
+    except TypeError:
+        return False
+
+
+def is_dupe_error(response) -> bool:
+    """Returns True if a JsonRPC response is an error stating the transaction was already broadcasted"""
+    err = response.get('error') if type(response) is dict else None
+    if type(err) is not dict:
+        return False
+    err = json.dumps(err).lower()
+    return any(d in err for d in broadcast_dupe_errors)
+
+
+async def json_broadcast_call(url, method, params, jid=1, timeout=BROADCAST_TIMEOUT):
+    """
+    Send a single JsonRPC request to ``url`` and return the decoded response, including any JsonRPC error.
+
+    Unlike :py:func:`.json_call` this never retries, as re-sending a broadcast risks submitting it twice.
+    """
+    headers = {'content-type': 'application/json'}
+    payload = {
+        "method": method,
+        "params": params,
+        "jsonrpc": "2.0",
+        "id": jid,
+    }
+    r = await rs.post(url, data=json.dumps(payload), headers=headers, timeout=timeout)
+    # Some nodes (e.g. behind jussi) return JsonRPC errors with a non-2xx status. Return any JsonRPC body so
+    # the caller can classify it, and only treat the status as a failure when there's nothing to classify.
+    try:
+        response = r.json()
+    except (JSONDecodeError, ValueError):
+        r.raise_for_status()
+        raise
+    if type(response) is dict and ('result' in response or 'error' in response):
+        return response
+    r.raise_for_status()
+    return response
+
+
+async def broadcast_call(method, params, jid=1):
+    """
+    Send a transaction broadcast to up to ``BROADCAST_FANOUT`` eligible endpoints in parallel, and return the
+    first successful response as a tuple of ``(response, endpoint)``. Each endpoint is only tried once.
+
+    A "duplicate transaction" error means the transaction already made it into the network, so it counts as a
+    success. For ``broadcast_transaction_synchronous`` we keep waiting for a real result (which contains the
+    block number). If no other node succeeds, an empty result ``{}`` is returned, as the block number
+    isn't available from a duplicate error.
+
+    If every node rejects the transaction, the first JsonRPC error returned is passed back to the client.
+    If every node failed to respond, an :py:class:`.EndpointException` is raised for the last failure.
+    """
+    _method = call_method(method, params)
+    endpoints = find_endpoints(_method, BROADCAST_FANOUT)
+    if len(endpoints) == 0:
+        raise EndpointException(f'No endpoints available to broadcast {_method}')
+    synchronous = _method.endswith('_synchronous')
+
+    async def _send(ep: Endpoint):
+        # Failures are returned rather than raised, as EndpointException is a BaseException, which Python 3.7
+        # re-raises out of the event loop when a task ends with it.
+        try:
+            return await json_broadcast_call(ep.host, method=method, params=params, jid=jid), ep, None
+        except asyncio.CancelledError:
+            # On Python 3.7 CancelledError is a subclass of Exception - don't turn our own cancellation into an error
+            raise
+        except Exception as e:
+            return None, ep, e
+
+    log.debug('Broadcasting %s to %s', _method, endpoints)
+    tasks = [asyncio.ensure_future(_send(ep)) for ep in endpoints]
+    dupe, rejected, ex = None, None, None
+    try:
+        for fut in asyncio.as_completed(tasks):
+            res, endpoint, err = await fut
+            if err is not None:
+                ex = EndpointException(
+                    f'Error while broadcasting {method} on {endpoint.host} - reason: {type(err)} {str(err)}',
+                    endpoint=endpoint
+                )
+                log.warning(str(ex))
+                continue
+
+            if type(res) is dict and 'error' in res:
+                if not is_dupe_error(res):
+                    log.info('Broadcast of %s rejected by %s: %s', _method, endpoint, res['error'])
+                    rejected = (res, endpoint) if rejected is None else rejected
+                    continue
+                log.info('Broadcast of %s to %s was a duplicate - treating as success', _method, endpoint)
+                if not synchronous:
+                    return dict(jsonrpc='2.0', result={}, id=jid), endpoint
+                dupe = endpoint if dupe is None else dupe
+                continue
+            return res, endpoint
+    finally:
+        # Stop waiting on the remaining nodes once we have an answer
+        for t in tasks:
+            if not t.done(): t.cancel()
+
+    if dupe is not None: return dict(jsonrpc='2.0', result={}, id=jid), dupe
+    if rejected is not None: return rejected
+    raise ex
+
+
+async def batch_broadcast_call(method, params, jid=1):
+    """
+    Wrapper around :py:func:`.broadcast_call` for broadcasts inside of a batch call. If every node fails to
+    respond, a JsonRPC error is returned for this call's ``id``, instead of failing the whole batch.
+    """
+    try:
+        return await broadcast_call(method, params, jid=jid)
+    except EndpointException as e:
+        log.warning('Broadcast within batch call failed - reason: %s', str(e))
+        host = 'Unknown' if e.endpoint is None else e.endpoint.host
+        err = dict(code=-32603, message=f"Unknown error from upstream {host}")
+        return dict(jsonrpc='2.0', error=err, id=jid), e.endpoint
+
+
+async def make_call(method, params, jid=1):
+    _method = call_method(method, params)
     endpoint = find_endpoint(_method)  # type: Endpoint
     # uri = urlparse(endpoint.host)
     # port = uri.port if uri.port is not None else 443 if uri.scheme == 'https' else 80
@@ -207,11 +339,16 @@ async def index():
             params = data.get('params', [])  # type: Union[dict, list]
 
             log.debug('Method: %s Params: %s', method, params)
-            call_list = [make_call(method=method, params=params, jid=data.get('id', 1))]
+            if is_broadcast(method, params):
+                call_list = [broadcast_call(method=method, params=params, jid=data.get('id', 1))]
+            else:
+                call_list = [make_call(method=method, params=params, jid=data.get('id', 1))]
         elif type(data) is list:
             if len(data) > MAX_BATCH:
                 return jsonify(error=True, message=f"Too many batch calls. Max batch calls is: {MAX_BATCH}")
-            call_dict = await filter_methods(data)
+            # Broadcasts are never batched, each one is fanned out individually via broadcast_call
+            broadcasts = [d for d in data if is_broadcast(d['method'], d.get('params', []))]
+            call_dict = await filter_methods([d for d in data if not is_broadcast(d['method'], d.get('params', []))])
             call_chunks = []
             for meth, rq in call_dict.items():
                 mcl = call_dict[meth]
@@ -224,6 +361,8 @@ async def index():
             call_list = []
             for c in call_chunks:
                 call_list.append(make_batch_call(c[0]['method'], c))
+            for b in broadcasts:
+                call_list.append(batch_broadcast_call(b['method'], b.get('params', []), jid=b.get('id', 1)))
 
         # else:
         #     raise Exception("JSON data was not dict or list.")
@@ -241,9 +380,14 @@ async def index():
         call_res = await asyncio.gather(*call_list)
         if len(call_res) == 1:
             res, endpoint = call_res[0]
+            # A batch containing only a broadcast should still get a list back
+            res = [res] if type(data) is list and type(res) is not list else res
             log.debug('Returning response: %s', res)
             resp = jsonify(res)
-            resp.headers['X-Upstream'] = endpoint.host if empty(endpoint.name) else endpoint.name
+            if endpoint is None:
+                resp.headers['X-Upstream'] = 'Unknown'
+            else:
+                resp.headers['X-Upstream'] = endpoint.host if empty(endpoint.name) else endpoint.name
         else:
             res = []
             for i, r in enumerate(call_res):
@@ -260,7 +404,8 @@ async def index():
         return jsonify(error=True, message="Incorrectly formatted 'params'. Must be list or dict"), 400
     except EndpointException as e:
         log.warning('Exception while calling JsonRPC server %s - reason: %s %s', e.endpoint, type(e), str(e))
-        return jsonify(error=True, message=f"Unknown error from upstream {e.endpoint.host}"), 502
+        host = 'Unknown' if e.endpoint is None else e.endpoint.host
+        return jsonify(error=True, message=f"Unknown error from upstream {host}"), 502
 
 
 if __name__ == "__main__":
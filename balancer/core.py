@@ -95,3 +95,17 @@ plugin_aliases = {
 
 MAX_BATCH = int(env('MAX_BATCH', 3000))
 CHUNK_SIZE = int(env('CHUNK_SIZE', 40))
+
+# Transaction broadcasts are sent to up to this many eligible nodes in parallel, returning the first success
+BROADCAST_FANOUT = int(env('BROADCAST_FANOUT', 3))
+BROADCAST_TIMEOUT = int(env('BROADCAST_TIMEOUT', 30))
+
+broadcast_calls = [
+    'broadcast_transaction',
+    'broadcast_transaction_synchronous',
+]
+
+# Lower-case fragments of upstream error messages which mean the transaction was already accepted by the network
+broadcast_dupe_errors = [
+    'duplicate transaction check failed',
+]
@@ -240,6 +240,25 @@ def find_endpoint(rcall: str) -> Endpoint:
     return weighted_endpoints[selection]
 
 
+def find_endpoints(rcall: str, count: int = 1) -> List[Endpoint]:
+    """
+    Randomly select up to ``count`` distinct endpoints that can handle the method ``rcall`` - taking into
+    question their weights. Used for calls which are sent to several nodes at once, e.g. transaction broadcasts.
+
+    :param str rcall: A method call such as ``condenser_api.broadcast_transaction``
+    :param int count: The maximum number of endpoints to return
+    :return List[Endpoint] endpoints: Weighted random endpoints capable of serving the given method, without duplicates
+    """
+    weighted_endpoints = list(weight_endpoint(rcall))
+    chosen = []
+    while len(weighted_endpoints) > 0 and len(chosen) < count:
+        ep = random.choice(weighted_endpoints)
+        chosen.append(ep)
+        # Remove every weighted copy of the chosen endpoint, so it can't be picked twice
+        weighted_endpoints = [e for e in weighted_endpoints if e.host != ep.host]
+    return chosen
+
+
 @r_cache(lambda rcall: f'stmnodes:{rcall}')
 def weight_endpoint(rcall):
     endpoints = get_nodes()